@@ -1,30 +1,62 @@
 #!/usr/bin/env python3
 """Generate VoiceCloneMemo app icon as .icns using CoreGraphics via PyObjC."""
 
+import hashlib
+import shutil
 import subprocess
 import os
 import sys
 import tempfile
 
+CACHE_DIR = os.path.expanduser("~/Library/Caches/VoiceCloneMemo")
+
+# Icons this small only hold a few dozen colors, so they are stored as palette PNGs
+PALETTE_PNGS = ["icon_16x16.png", "icon_16x16@2x.png", "icon_32x32.png"]
+
 def generate_icon_png(size, output_path):
     """Generate a single PNG icon at the given size."""
     # Use sips + CoreImage via a small swift script
     pass
 
 def main():
-    icon_dir = os.path.join(tempfile.gettempdir(), "VoiceCloneMemo.iconset")
-    os.makedirs(icon_dir, exist_ok=True)
-
     # Generate icon using Swift (access to CoreGraphics natively)
     swift_code = r'''
 import Cocoa
+import ImageIO
+import UniformTypeIdentifiers
 
-func drawIcon(size: Int, scale: Int, path: String) {
-    let s = CGFloat(size * scale)
-    let image = NSImage(size: NSSize(width: s, height: s))
-    image.lockFocus()
+// Shared drawing resources, created once for all sizes
+let colorSpace = CGColorSpaceCreateDeviceRGB()
+
+// Gradient: deep purple to blue
+let gradientStart: [CGFloat] = [0.35, 0.10, 0.85]
+let gradientEnd: [CGFloat] = [0.15, 0.45, 0.95]
+let gradientColors = [
+    CGColor(red: gradientStart[0], green: gradientStart[1], blue: gradientStart[2], alpha: 1.0),
+    CGColor(red: gradientEnd[0], green: gradientEnd[1], blue: gradientEnd[2], alpha: 1.0)
+] as CFArray
+let backgroundGradient = CGGradient(colorsSpace: colorSpace, colors: gradientColors, locations: [0.0, 1.0])
 
-    let ctx = NSGraphicsContext.current!.cgContext
+// Below this pixel size the gradient is drawn as flat stripes (no shading pass)
+let stripedGradientMaxPixels = 32
+let gradientStripeCount = 8
+
+func drawIcon(size: Int, scale: Int, path: String) {
+    let pixels = size * scale
+    let s = CGFloat(pixels)
+
+    // Draw straight into a bitmap context (no NSImage focus lock or TIFF round-trip)
+    guard let ctx = CGContext(
+        data: nil,
+        width: pixels,
+        height: pixels,
+        bitsPerComponent: 8,
+        bytesPerRow: 0,
+        space: colorSpace,
+        bitmapInfo: CGImageAlphaInfo.premultipliedLast.rawValue
+    ) else {
+        return
+    }
 
     // Background: rounded rect with gradient
     let rect = CGRect(x: 0, y: 0, width: s, height: s)
@@ -33,13 +65,24 @@ func drawIcon(size: Int, scale: Int, path: String) {
     ctx.addPath(bgPath)
     ctx.clip()
 
-    // Gradient: deep purple to blue
-    let colorSpace = CGColorSpaceCreateDeviceRGB()
-    let colors = [
-        CGColor(red: 0.35, green: 0.10, blue: 0.85, alpha: 1.0),
-        CGColor(red: 0.15, green: 0.45, blue: 0.95, alpha: 1.0)
-    ] as CFArray
-    if let gradient = CGGradient(colorsSpace: colorSpace, colors: colors, locations: [0.0, 1.0]) {
+    if pixels <= stripedGradientMaxPixels {
+        // Diagonal stripes, top-left to bottom-right, each filled with a lerped color.
+        // Every stripe runs to the far edge and the next one paints over it, so the
+        // antialiased stripe boundaries never leave partially covered seams.
+        let diagonal = s * 2.0.squareRoot()
+        let stripeWidth = diagonal / CGFloat(gradientStripeCount)
+        ctx.saveGState()
+        ctx.translateBy(x: s / 2, y: s / 2)
+        ctx.rotate(by: -.pi / 4)
+        for i in 0..<gradientStripeCount {
+            let t = (CGFloat(i) + 0.5) / CGFloat(gradientStripeCount)
+            let c = (0..<3).map { gradientStart[$0] + (gradientEnd[$0] - gradientStart[$0]) * t }
+            ctx.setFillColor(CGColor(red: c[0], green: c[1], blue: c[2], alpha: 1.0))
+            let x = -diagonal / 2 + CGFloat(i) * stripeWidth
+            ctx.fill(CGRect(x: x, y: -diagonal / 2, width: diagonal / 2 - x, height: diagonal))
+        }
+        ctx.restoreGState()
+    } else if let gradient = backgroundGradient {
         ctx.drawLinearGradient(gradient, start: CGPoint(x: 0, y: s), end: CGPoint(x: s, y: 0), options: [])
     }
 
@@ -53,17 +96,18 @@ func drawIcon(size: Int, scale: Int, path: String) {
 
     let heights: [CGFloat] = [0.3, 0.55, 0.8, 1.0, 0.75, 0.5, 0.25]
 
-    ctx.setFillColor(CGColor(red: 1, green: 1, blue: 1, alpha: 0.9))
-
+    // All bars share one path so they are rasterized in a single fill
+    let barsPath = CGMutablePath()
     for i in 0..<barCount {
         let h = maxBarHeight * heights[i]
         let x = startX + CGFloat(i) * spacing
         let y = centerY - h / 2
         let barRect = CGRect(x: x, y: y, width: barWidth, height: h)
-        let barPath = CGPath(roundedRect: barRect, cornerWidth: barWidth / 2, cornerHeight: barWidth / 2, transform: nil)
-        ctx.addPath(barPath)
-        ctx.fillPath()
+        barsPath.addRoundedRect(in: barRect, cornerWidth: barWidth / 2, cornerHeight: barWidth / 2)
     }
+    ctx.setFillColor(CGColor(red: 1, green: 1, blue: 1, alpha: 0.9))
+    ctx.addPath(barsPath)
+    ctx.fillPath()
 
     // Microphone icon (right side)
     let micX = s * 0.72
@@ -71,10 +115,21 @@ func drawIcon(size: Int, scale: Int, path: String) {
     let micW = s * 0.12
     let micH = s * 0.22
 
-    // Mic body
-    ctx.setFillColor(CGColor(red: 1, green: 1, blue: 1, alpha: 0.95))
+    // Mic body, stand and base are filled together as one path
+    let micPath = CGMutablePath()
     let micRect = CGRect(x: micX, y: micY, width: micW, height: micH)
-    let micPath = CGPath(roundedRect: micRect, cornerWidth: micW / 2, cornerHeight: micW / 2, transform: nil)
+    micPath.addRoundedRect(in: micRect, cornerWidth: micW / 2, cornerHeight: micW / 2)
+
+    // Mic stand
+    let standX = micX + micW / 2 - s * 0.01
+    let standRect = CGRect(x: standX, y: micY - s * 0.08, width: s * 0.02, height: s * 0.08)
+    micPath.addRect(standRect)
+
+    // Stand base
+    let baseRect = CGRect(x: micX + micW / 2 - s * 0.04, y: micY - s * 0.10, width: s * 0.08, height: s * 0.025)
+    micPath.addRoundedRect(in: baseRect, cornerWidth: s * 0.01, cornerHeight: s * 0.01)
+
+    ctx.setFillColor(CGColor(red: 1, green: 1, blue: 1, alpha: 0.95))
     ctx.addPath(micPath)
     ctx.fillPath()
 
@@ -86,60 +141,109 @@ func drawIcon(size: Int, scale: Int, path: String) {
     ctx.addArc(center: arcCenter, radius: arcRadius, startAngle: .pi * 0.15, endAngle: .pi * 0.85, clockwise: false)
     ctx.strokePath()
 
-    // Mic stand
-    let standX = micX + micW / 2 - s * 0.01
-    let standRect = CGRect(x: standX, y: micY - s * 0.08, width: s * 0.02, height: s * 0.08)
-    ctx.fill(standRect)
-
-    // Stand base
-    let baseRect = CGRect(x: micX + micW / 2 - s * 0.04, y: micY - s * 0.10, width: s * 0.08, height: s * 0.025)
-    let basePath = CGPath(roundedRect: baseRect, cornerWidth: s * 0.01, cornerHeight: s * 0.01, transform: nil)
-    ctx.addPath(basePath)
-    ctx.fillPath()
-
-    image.unlockFocus()
-
     // Save as PNG
-    guard let tiffData = image.tiffRepresentation,
-          let bitmap = NSBitmapImageRep(data: tiffData),
-          let pngData = bitmap.representation(using: .png, properties: [:]) else {
+    guard let cgImage = ctx.makeImage(),
+          let dest = CGImageDestinationCreateWithURL(URL(fileURLWithPath: path) as CFURL, UTType.png.identifier as CFString, 1, nil) else {
         return
     }
-    try? pngData.write(to: URL(fileURLWithPath: path))
+    CGImageDestinationAddImage(dest, cgImage, nil)
+    CGImageDestinationFinalize(dest)
 }
 
 let iconsetDir = CommandLine.arguments[1]
 let sizes = [(16, 1), (16, 2), (32, 1), (32, 2), (128, 1), (128, 2), (256, 1), (256, 2), (512, 1), (512, 2)]
 
-for (size, scale) in sizes {
+let filenames = sizes.map { (size, scale) -> String in
     let suffix = scale == 1 ? "" : "@2x"
-    let filename = "icon_\(size)x\(size)\(suffix).png"
-    let path = "\(iconsetDir)/\(filename)"
-    drawIcon(size: size, scale: scale, path: path)
+    return "icon_\(size)x\(size)\(suffix).png"
+}
+
+// Each icon is independent, so rasterize them in parallel across cores
+DispatchQueue.concurrentPerform(iterations: sizes.count) { i in
+    let (size, scale) = sizes[i]
+    drawIcon(size: size, scale: scale, path: "\(iconsetDir)/\(filenames[i])")
+}
+
+for filename in filenames {
     print("Generated \(filename)")
 }
 '''
 
-    # Write and run the Swift script
+    # Skip the whole pipeline when the drawing code and post-processing are unchanged
+    output_icns = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "AppIcon.icns")
+    hash_path = f"{output_icns}.hash"
+    icon_inputs = [swift_code, *PALETTE_PNGS, f"pngquant={bool(shutil.which('pngquant'))}"]
+    key = hashlib.sha256("\n".join(icon_inputs).encode("utf-8")).hexdigest()
+    if os.path.exists(output_icns) and os.path.exists(hash_path):
+        with open(hash_path) as f:
+            if f.read().strip() == key:
+                print(f"{output_icns} up to date")
+                return
+
+    # Fresh iconset per run, removed once iconutil has read it
+    icon_dir = tempfile.mkdtemp(prefix="VoiceCloneMemo-", suffix=".iconset")
+
+    # Write the Swift script
     swift_path = os.path.join(tempfile.gettempdir(), "gen_icon.swift")
     with open(swift_path, "w") as f:
         f.write(swift_code)
 
-    result = subprocess.run(
-        ["swift", swift_path, icon_dir],
-        capture_output=True, text=True
-    )
+    # Compile once with swiftc and reuse the binary while the source is unchanged,
+    # so repeated runs skip the interpreter's parse/typecheck startup
+    swift_hash = hashlib.sha256(swift_code.encode("utf-8")).hexdigest()[:16]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    cached_bin = os.path.join(CACHE_DIR, f"gen_icon-{swift_hash}")
+    if not os.path.exists(cached_bin):
+        # Compile under a temporary name so an interrupted build is never mistaken for a good one
+        tmp_bin = f"{cached_bin}.{os.getpid()}.tmp"
+        compiled = subprocess.run(
+            ["swiftc", "-O", swift_path, "-o", tmp_bin],
+            capture_output=True, text=True
+        )
+        if compiled.returncode == 0:
+            os.replace(tmp_bin, cached_bin)
+            # Drop binaries built from older versions of the drawing code
+            for name in os.listdir(CACHE_DIR):
+                if name.startswith("gen_icon-") and name != os.path.basename(cached_bin):
+                    os.remove(os.path.join(CACHE_DIR, name))
+        else:
+            print(compiled.stderr, file=sys.stderr)
+            if os.path.exists(tmp_bin):
+                os.remove(tmp_bin)
+
+    if os.path.exists(cached_bin):
+        command = [cached_bin, icon_dir]
+    else:
+        command = ["swift", swift_path, icon_dir]
+
+    result = subprocess.run(command, capture_output=True, text=True)
     print(result.stdout)
     if result.stderr:
         print(result.stderr, file=sys.stderr)
 
     if result.returncode != 0:
         print("Error generating icon PNGs", file=sys.stderr)
+        shutil.rmtree(icon_dir, ignore_errors=True)
         sys.exit(1)
 
-    # Convert iconset to icns
-    output_icns = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "AppIcon.icns")
-    subprocess.run(["iconutil", "-c", "icns", icon_dir, "-o", output_icns], check=True)
+    # Quantize the smallest icons to PNG8 when pngquant is available
+    if shutil.which("pngquant"):
+        subprocess.run(
+            ["pngquant", "--speed", "1", "--quality", "90-100", "--force", "--ext", ".png"]
+            + [os.path.join(icon_dir, name) for name in PALETTE_PNGS]
+        )
+
+    # Convert iconset to icns, swapping the result into place atomically
+    tmp_icns = os.path.join(os.path.dirname(output_icns), ".AppIcon.tmp.icns")
+    try:
+        subprocess.run(["iconutil", "-c", "icns", icon_dir, "-o", tmp_icns], check=True)
+        os.replace(tmp_icns, output_icns)
+    finally:
+        shutil.rmtree(icon_dir, ignore_errors=True)
+        if os.path.exists(tmp_icns):
+            os.remove(tmp_icns)
+    with open(hash_path, "w") as f:
+        f.write(key)
     print(f"Generated {output_icns}")
 
 if __name__ == "__main__":
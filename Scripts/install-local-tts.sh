@@ -32,7 +32,7 @@ conda activate vcm
 # 3. Python deps
 echo "[3/5] Dépendances Python..."
 pip install --quiet torch torchvision torchaudio
-pip install --quiet flask soundfile scipy transformers accelerate huggingface_hub
+pip install --quiet flask waitress orjson soundfile scipy transformers accelerate huggingface_hub
 
 # 4. Download model
 echo "[4/5] Téléchargement modèle Qwen3-TTS 1.7B (~4 Go)..."
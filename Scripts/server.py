@@ -3,45 +3,452 @@
 
 import os
 import sys
-import json
+import shutil
 import base64
+import hashlib
+import io
+import queue
 import tempfile
+import threading
 import uuid
 import time
+from collections import OrderedDict
 from pathlib import Path
 
+import orjson
+import soundfile as sf
+import torch
 from flask import Flask, request, jsonify, send_file
+from flask.json.provider import DefaultJSONProvider
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024
 
 # Globals
 model = None
 processor = None
+DEVICE = None
+_static_cache = None
+_eager_forward = None
+# Model configuration folded into TTS cache keys, so switching configs never serves stale audio
+MODEL_FINGERPRINT = ""
 MODEL_PATH = os.path.expanduser("~/.voiceclonememo/model")
 VOICES_DIR = os.path.expanduser("~/.voiceclonememo/voices")
 OUTPUT_DIR = os.path.expanduser("~/.voiceclonememo/output")
+# Set VCM_KEEP_OUTPUT=1 to also keep a copy of every generated memo in OUTPUT_DIR
+KEEP_OUTPUT = os.environ.get("VCM_KEEP_OUTPUT", "0") == "1"
+# Set VCM_QUANTIZE=int8 to load weight-only int8 weights (needs optimum-quanto)
+QUANTIZE = os.environ.get("VCM_QUANTIZE", "")
 os.makedirs(VOICES_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Content-addressed WAVs for repeated (voice_id, text) requests, evicted least recently used first
+TTS_CACHE_DIR = os.path.expanduser("~/.voiceclonememo/cache")
+TTS_CACHE_SIZE = 500
+os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+
+# Single manifest of every voice's meta.json, so listing voices is one read
+VOICES_INDEX = os.path.join(VOICES_DIR, "index.json")
+_voices_index_lock = threading.Lock()
+_model_lock = threading.Lock()
+
+MAX_NEW_TOKENS = 2048
+# Room for the prompt (text + reference audio tokens) plus the decode budget
+STATIC_CACHE_LEN = 4096
+
+# voice_id -> audio-side processor tensors, so reference audio is encoded once per voice
+VOICE_CACHE_SIZE = 32
+
+# Concurrent /v1/tts requests arriving within the window are generated as one batch
+BATCH_MAX = 4
+BATCH_WINDOW_MS = 20
+# Longest a request thread waits on the worker before giving up with 504
+TTS_TIMEOUT_S = 300
+# Waiting TTS requests hold a server thread each; keep spare threads for /health and /v1/voices
+SERVER_THREADS = BATCH_MAX + 4
+_tts_queue = queue.Queue()
+# Encoded reference audio saved next to reference.wav at clone time
+AUDIO_TOKENS_FILE = "audio_tokens.pt"
+TEXT_INPUT_KEYS = ("input_ids", "attention_mask")
+# The reference prompt's own tokens (transcript, audio placeholders), prepended to the text's
+REFERENCE_INPUT_KEYS = {"input_ids": "reference_input_ids", "attention_mask": "reference_attention_mask"}
+_voice_cache = OrderedDict()
+
+def read_voices_index():
+    with open(VOICES_INDEX, "rb") as f:
+        return orjson.loads(f.read())
+
+def write_voices_index(index):
+    tmp_path = f"{VOICES_INDEX}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(index))
+    os.replace(tmp_path, VOICES_INDEX)
+
+def reconcile_voices_index():
+    """Bring the manifest in line with the per-voice meta.json files on disk."""
+    with _voices_index_lock:
+        index = {}
+        for d in os.listdir(VOICES_DIR):
+            meta_path = os.path.join(VOICES_DIR, d, "meta.json")
+            if os.path.exists(meta_path):
+                with open(meta_path, "rb") as f:
+                    meta = orjson.loads(f.read())
+                index[meta.get("voice_id", d)] = meta
+        try:
+            current = read_voices_index()
+        except (OSError, ValueError):
+            current = None
+        if index != current:
+            write_voices_index(index)
+
 def load_model():
-    global model, processor
-    import torch
+    global model, processor, DEVICE, _eager_forward, MODEL_FINGERPRINT
     from transformers import AutoModelForCausalLM, AutoProcessor
 
     print("Chargement du modele Qwen3-TTS 1.7B...")
     device = "mps" if torch.backends.mps.is_available() else "cpu"
-    print(f"Device: {device}")
+    # Half precision is the fast path on MPS; CPU stays in float32
+    dtype = torch.float16 if device == "mps" else torch.float32
+    print(f"Device: {device} ({dtype})")
+    DEVICE = torch.device(device)
+
+    compile_model = os.environ.get("VCM_TORCH_COMPILE", "0") == "1"
+    MODEL_FINGERPRINT = f"{MODEL_PATH}|{dtype}|quantize={QUANTIZE}|compile={compile_model}"
+
+    load_kwargs = {}
+    if QUANTIZE == "int8":
+        from transformers import QuantoConfig
+        load_kwargs["quantization_config"] = QuantoConfig(weights="int8")
+        print("Quantification: int8 (poids)")
 
     processor = AutoProcessor.from_pretrained(MODEL_PATH, trust_remote_code=True)
     model = AutoModelForCausalLM.from_pretrained(
         MODEL_PATH,
         trust_remote_code=True,
-        torch_dtype=torch.float32,
+        torch_dtype=dtype,
         device_map=device,
-        attn_implementation="sdpa"
+        attn_implementation="sdpa",
+        **load_kwargs
     )
+    if compile_model:
+        # Opt-in: compile the forward pass used by generate(), falling back to eager if it fails
+        _eager_forward = model.forward
+        model.forward = torch.compile(model.forward, fullgraph=False)
     print("Modele charge !")
 
+def save_upload(upload, path):
+    """Copy an uploaded file to path in 1 MiB chunks."""
+    stream = upload.stream
+    stream.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(stream, out, 1 << 20)
+
+def reference_inputs(ref_audio, ref_text):
+    """Run the processor on a reference recording, keeping its prompt tokens under REFERENCE_INPUT_KEYS.
+
+    Returns None when the processor cannot encode the reference without text.
+    """
+    proc_kwargs = {
+        "audio": ref_audio,
+        "return_tensors": "pt",
+        "trust_remote_code": True
+    }
+    if ref_text:
+        proc_kwargs["reference_text"] = ref_text
+
+    try:
+        inputs = processor(**proc_kwargs)
+    except Exception as e:
+        print(f"Encodage de la reference seule impossible: {e}", file=sys.stderr)
+        return None
+    audio_inputs = {k: v for k, v in inputs.items() if k not in TEXT_INPUT_KEYS}
+    for k, ref_key in REFERENCE_INPUT_KEYS.items():
+        if k in inputs:
+            audio_inputs[ref_key] = inputs[k]
+    return audio_inputs
+
+def merge_voice_inputs(text_inputs, audio_inputs):
+    """Combine text-only inputs with a voice's encoded reference, prompt tokens first."""
+    inputs = dict(text_inputs)
+    for k, v in audio_inputs.items():
+        if k not in REFERENCE_INPUT_KEYS.values():
+            inputs[k] = v
+    for k, ref_key in REFERENCE_INPUT_KEYS.items():
+        if ref_key in audio_inputs and k in text_inputs:
+            inputs[k] = torch.cat([audio_inputs[ref_key], text_inputs[k]], dim=-1)
+    return inputs
+
+def full_voice_inputs(text, ref_audio, ref_text):
+    """The combined processor call the model was built around: text, reference audio and transcript."""
+    proc_kwargs = {
+        "text": text,
+        "audio": ref_audio,
+        "return_tensors": "pt",
+        "trust_remote_code": True
+    }
+    if ref_text:
+        proc_kwargs["reference_text"] = ref_text
+    return processor(**proc_kwargs)
+
+def same_inputs(a, b):
+    """True when two processor outputs hold the same keys and identical values."""
+    if set(a.keys()) != set(b.keys()):
+        return False
+    for k, v in b.items():
+        other = a[k]
+        if torch.is_tensor(v):
+            if not (torch.is_tensor(other) and other.shape == v.shape and torch.equal(other, v)):
+                return False
+        elif other != v:
+            return False
+    return True
+
+def voice_inputs(text, voice_id, ref_audio, ref_text):
+    """Build processor inputs for a cloned voice, reusing its encoded reference audio.
+
+    The first use of a voice checks the cached merge against the full processor call;
+    if the two differ, the voice is cached as None and always takes the full call.
+    """
+    if voice_id in _voice_cache:
+        audio_inputs = _voice_cache[voice_id]
+        _voice_cache.move_to_end(voice_id)
+        if audio_inputs is None:
+            return full_voice_inputs(text, ref_audio, ref_text)
+        text_inputs = processor(text=text, return_tensors="pt", trust_remote_code=True)
+        return merge_voice_inputs(text_inputs, audio_inputs)
+
+    tokens_path = os.path.join(VOICES_DIR, voice_id, AUDIO_TOKENS_FILE)
+    if os.path.exists(tokens_path):
+        audio_inputs = torch.load(tokens_path, map_location="cpu", weights_only=True, mmap=True)
+    else:
+        audio_inputs = reference_inputs(ref_audio, ref_text)
+
+    inputs = full_voice_inputs(text, ref_audio, ref_text)
+    if audio_inputs is not None:
+        text_inputs = processor(text=text, return_tensors="pt", trust_remote_code=True)
+        if not same_inputs(merge_voice_inputs(text_inputs, audio_inputs), inputs):
+            print(f"Voix {voice_id}: entrees fusionnees differentes, encodage complet", file=sys.stderr)
+            audio_inputs = None
+
+    # None is cached too, so a voice that cannot be merged is not re-checked on every request
+    _voice_cache[voice_id] = audio_inputs
+    if len(_voice_cache) > VOICE_CACHE_SIZE:
+        _voice_cache.popitem(last=False)
+    return inputs
+
+def cached_speech_path(text, voice_id):
+    key = hashlib.sha256(f"{MODEL_FINGERPRINT}|{voice_id}|{text}".encode("utf-8")).hexdigest()
+    return os.path.join(TTS_CACHE_DIR, f"{key}.wav")
+
+def store_cached_speech(path, wav_bytes):
+    """Atomically add a generated WAV to the cache, then trim it to TTS_CACHE_SIZE."""
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(wav_bytes)
+    os.replace(tmp_path, path)
+
+    entries = []
+    for name in os.listdir(TTS_CACHE_DIR):
+        if name.endswith(".wav"):
+            entry = os.path.join(TTS_CACHE_DIR, name)
+            try:
+                entries.append((os.stat(entry).st_atime, entry))
+            except FileNotFoundError:
+                continue
+    if len(entries) > TTS_CACHE_SIZE:
+        entries.sort()
+        for _, entry in entries[:len(entries) - TTS_CACHE_SIZE]:
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+
+def token_budget(text):
+    """Decode budget for an utterance, roughly proportional to its length."""
+    return min(MAX_NEW_TOKENS, 20 + len(text) * 12)
+
+def static_cache(device):
+    """KV cache allocated once and reset between requests instead of reallocated."""
+    global _static_cache
+    from transformers import StaticCache
+
+    if _static_cache is None:
+        _static_cache = StaticCache(
+            config=model.config,
+            max_batch_size=1,
+            max_cache_len=STATIC_CACHE_LEN,
+            device=device,
+            dtype=model.dtype
+        )
+    else:
+        _static_cache.reset()
+    return _static_cache
+
+class TTSJob:
+    """A queued /v1/tts request, completed by the batch worker."""
+
+    def __init__(self, text, voice_id):
+        self.text = text
+        self.voice_id = voice_id
+        self.inputs = None
+        self.audio = None
+        self.error = None
+        # Set when the request timed out; the worker skips the job instead of generating it
+        self.abandoned = False
+        self.done = threading.Event()
+
+def speech_inputs(text, voice_id):
+    """Processor inputs for one utterance, with the cloned voice when it exists."""
+    if voice_id and os.path.exists(os.path.join(VOICES_DIR, voice_id, "reference.wav")):
+        ref_audio = os.path.join(VOICES_DIR, voice_id, "reference.wav")
+
+        # Load transcript if available (improves cloning quality)
+        ref_text = None
+        meta_path = os.path.join(VOICES_DIR, voice_id, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "rb") as mf:
+                meta = orjson.loads(mf.read())
+                ref_text = meta.get("transcript", "")
+                if not ref_text:
+                    ref_text = None
+
+        return voice_inputs(text, voice_id, ref_audio, ref_text)
+
+    return processor(
+        text=text,
+        return_tensors="pt",
+        trust_remote_code=True
+    )
+
+def batch_key(inputs):
+    """Jobs can share a batch only when their audio-side tensors have the same shapes
+    and their other audio-side values are equal, since collate takes those from the first job."""
+    return tuple(sorted(
+        (k, ("tensor", tuple(v.shape)) if torch.is_tensor(v) else ("value", repr(v)))
+        for k, v in inputs.items()
+        if k not in TEXT_INPUT_KEYS
+    ))
+
+def collate(jobs, pad_token_id):
+    """Left-pad text tokens and stack audio-side tensors into one batch."""
+    rows = [job.inputs["input_ids"][0] for job in jobs]
+    masks = [job.inputs.get("attention_mask", torch.ones_like(job.inputs["input_ids"]))[0] for job in jobs]
+    width = max(row.shape[-1] for row in rows)
+
+    batch = dict(jobs[0].inputs)
+    batch["input_ids"] = torch.stack([
+        torch.cat([row.new_full((width - row.shape[-1],), pad_token_id), row]) for row in rows
+    ])
+    batch["attention_mask"] = torch.stack([
+        torch.cat([mask.new_zeros(width - mask.shape[-1]), mask]) for mask in masks
+    ])
+    for k, v in jobs[0].inputs.items():
+        if k not in TEXT_INPUT_KEYS and torch.is_tensor(v):
+            batch[k] = torch.cat([job.inputs[k] for job in jobs], dim=0)
+    return batch, [width - row.shape[-1] for row in rows]
+
+def generate(**kwargs):
+    """model.generate, restoring the eager forward pass if the compiled one fails."""
+    global _eager_forward
+    try:
+        return model.generate(**kwargs)
+    except Exception as e:
+        if _eager_forward is None:
+            raise
+        print(f"torch.compile indisponible, retour en mode eager: {e}", file=sys.stderr)
+        model.forward = _eager_forward
+        _eager_forward = None
+        cache = kwargs.get("past_key_values")
+        if cache is not None:
+            cache.reset()
+        return model.generate(**kwargs)
+
+def run_batch(jobs):
+    """Generate every job in one model.generate call and decode each row."""
+    try:
+        pad_token_id = processor.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = processor.tokenizer.eos_token_id
+        max_new_tokens = max(token_budget(job.text) for job in jobs)
+        if len(jobs) == 1:
+            inputs, offsets = jobs[0].inputs, [0]
+            # Long reference prompts would overflow the static cache; let generate() allocate one
+            fits = inputs["input_ids"].shape[-1] + max_new_tokens <= STATIC_CACHE_LEN
+            cache = static_cache(DEVICE) if fits else None
+        else:
+            inputs, offsets = collate(jobs, pad_token_id)
+            cache = None
+
+        inputs = {k: (v.to(DEVICE, non_blocking=True) if torch.is_tensor(v) else v) for k, v in inputs.items()}
+
+        with torch.no_grad(), torch.autocast(device_type=DEVICE.type, dtype=model.dtype, enabled=DEVICE.type == "mps"):
+            output = generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                use_cache=True,
+                past_key_values=cache,
+                pad_token_id=pad_token_id
+            )
+
+        for job, offset, row in zip(jobs, offsets, output):
+            row = row[offset:]
+            if len(jobs) > 1:
+                # Drop the padding generate() appends to rows that finished early
+                kept = (row != pad_token_id).nonzero()
+                row = row[:kept[-1].item() + 1] if len(kept) else row
+            job.audio = processor.decode(row, return_tensors=False)
+    except Exception as e:
+        for job in jobs:
+            job.error = e
+
+def tts_worker():
+    """Collect queued jobs for up to BATCH_WINDOW_MS, then generate them together."""
+    while True:
+        jobs = [_tts_queue.get()]
+        try:
+            deadline = time.monotonic() + BATCH_WINDOW_MS / 1000
+            while len(jobs) < BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(_tts_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # One generation at a time on the GPU; other endpoints keep serving meanwhile
+            with _model_lock:
+                batches = {}
+                for job in jobs:
+                    if job.abandoned:
+                        continue
+                    try:
+                        job.inputs = speech_inputs(job.text, job.voice_id)
+                        batches.setdefault(batch_key(job.inputs), []).append(job)
+                    except Exception as e:
+                        job.error = e
+
+                for batch in batches.values():
+                    run_batch(batch)
+        except Exception as e:
+            # Keep the worker alive; every job still waiting gets the error instead of a timeout
+            for job in jobs:
+                if job.audio is None and job.error is None:
+                    job.error = e
+        finally:
+            for job in jobs:
+                job.done.set()
+
 @app.route("/health", methods=["GET"])
 def health():
     return jsonify({"status": "ok", "model": "qwen3-tts-1.7b"})
@@ -61,20 +468,34 @@ def clone_voice():
     os.makedirs(voice_dir, exist_ok=True)
 
     audio_path = os.path.join(voice_dir, "reference.wav")
-    audio_file.save(audio_path)
+    save_upload(audio_file, audio_path)
+
+    # Encode the reference now so /v1/tts does not have to. Never wait behind a running
+    # generation: when the model is busy, the first /v1/tts for this voice encodes it instead.
+    if processor is not None and _model_lock.acquire(blocking=False):
+        try:
+            audio_inputs = reference_inputs(audio_path, transcript)
+            if audio_inputs is not None:
+                torch.save(audio_inputs, os.path.join(voice_dir, AUDIO_TOKENS_FILE))
+        except Exception as e:
+            print(f"Encodage de la reference differe: {e}", file=sys.stderr)
+        finally:
+            _model_lock.release()
 
     meta = {"name": name, "voice_id": voice_id, "audio": audio_path, "transcript": transcript}
-    with open(os.path.join(voice_dir, "meta.json"), "w") as f:
-        json.dump(meta, f)
+    with open(os.path.join(voice_dir, "meta.json"), "wb") as f:
+        f.write(orjson.dumps(meta))
+
+    with _voices_index_lock:
+        index = read_voices_index() if os.path.exists(VOICES_INDEX) else {}
+        index[voice_id] = meta
+        write_voices_index(index)
 
     return jsonify({"voice_id": voice_id, "name": name})
 
 @app.route("/v1/tts", methods=["POST"])
 def text_to_speech():
     """Generate speech from text, optionally with a cloned voice."""
-    import torch
-    import soundfile as sf
-
     data = request.get_json()
     text = data.get("text", "")
     voice_id = data.get("voice_id", "")
@@ -82,49 +503,35 @@ def text_to_speech():
     if not text:
         return jsonify({"error": "No text provided"}), 400
 
-    try:
-        if voice_id and os.path.exists(os.path.join(VOICES_DIR, voice_id, "reference.wav")):
-            ref_audio = os.path.join(VOICES_DIR, voice_id, "reference.wav")
+    cache_path = cached_speech_path(text, voice_id)
+    if os.path.exists(cache_path):
+        # Refresh the access time so eviction treats this entry as recently used
+        os.utime(cache_path)
+        return send_file(cache_path, mimetype="audio/wav", conditional=True)
 
-            # Load transcript if available (improves cloning quality)
-            ref_text = None
-            meta_path = os.path.join(VOICES_DIR, voice_id, "meta.json")
-            if os.path.exists(meta_path):
-                with open(meta_path) as mf:
-                    meta = json.load(mf)
-                    ref_text = meta.get("transcript", "")
-                    if not ref_text:
-                        ref_text = None
-
-            proc_kwargs = {
-                "text": text,
-                "audio": ref_audio,
-                "return_tensors": "pt",
-                "trust_remote_code": True
-            }
-            if ref_text:
-                proc_kwargs["reference_text"] = ref_text
-
-            inputs = processor(**proc_kwargs)
-        else:
-            inputs = processor(
-                text=text,
-                return_tensors="pt",
-                trust_remote_code=True
-            )
-
-        device = "mps" if torch.backends.mps.is_available() else "cpu"
-        inputs = {k: v.to(device) if hasattr(v, 'to') else v for k, v in inputs.items()}
-
-        with torch.no_grad():
-            output = model.generate(**inputs, max_new_tokens=2048)
+    try:
+        job = TTSJob(text, voice_id)
+        _tts_queue.put(job)
+        if not job.done.wait(TTS_TIMEOUT_S):
+            job.abandoned = True
+            return jsonify({"error": "TTS generation timed out"}), 504
+        if job.error is not None:
+            raise job.error
+        audio_array = job.audio
 
-        audio_array = processor.decode(output[0], return_tensors=False)
+        buf = io.BytesIO()
+        sf.write(buf, audio_array, 24000, format="WAV", subtype="PCM_16")
+        store_cached_speech(cache_path, buf.getvalue())
 
-        output_path = os.path.join(OUTPUT_DIR, f"memo_{int(time.time())}.wav")
-        sf.write(output_path, audio_array, 24000)
+        filename = f"memo_{int(time.time())}.wav"
+        if KEEP_OUTPUT:
+            output_path = os.path.join(OUTPUT_DIR, filename)
+            with open(output_path, "wb") as f:
+                f.write(buf.getvalue())
+            return send_file(output_path, mimetype="audio/wav", conditional=True)
 
-        return send_file(output_path, mimetype="audio/wav")
+        buf.seek(0)
+        return send_file(buf, mimetype="audio/wav", download_name=filename)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -132,15 +539,18 @@ def text_to_speech():
 @app.route("/v1/voices", methods=["GET"])
 def list_voices():
     """List saved voice profiles."""
-    voices = []
-    for d in os.listdir(VOICES_DIR):
-        meta_path = os.path.join(VOICES_DIR, d, "meta.json")
-        if os.path.exists(meta_path):
-            with open(meta_path) as f:
-                voices.append(json.load(f))
-    return jsonify({"voices": voices})
+    with _voices_index_lock:
+        index = read_voices_index() if os.path.exists(VOICES_INDEX) else {}
+    return jsonify({"voices": list(index.values())})
 
 if __name__ == "__main__":
+    reconcile_voices_index()
     load_model()
+    threading.Thread(target=tts_worker, daemon=True).start()
     print("Qwen3-TTS serveur local sur http://localhost:5123")
-    app.run(host="127.0.0.1", port=5123, debug=False)
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host="127.0.0.1", port=5123, debug=False, threaded=True)
+    else:
+        serve(app, host="127.0.0.1", port=5123, threads=SERVER_THREADS)
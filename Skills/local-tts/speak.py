@@ -5,6 +5,7 @@ import sys
 import os
 import json
 import argparse
+import shutil
 import time
 import urllib.request
 import urllib.error
@@ -41,11 +42,6 @@ def list_voices():
 
 def generate(text, voice_id=None):
     """Generate speech and return the file path."""
-    if not check_server():
-        print("Erreur: serveur local non démarré. Lance VoiceCloneMemo ou:", file=sys.stderr)
-        print("  bash ~/.voiceclonememo/start.sh", file=sys.stderr)
-        sys.exit(1)
-
     payload = {"text": text}
     if voice_id:
         payload["voice_id"] = voice_id
@@ -58,13 +54,16 @@ def generate(text, voice_id=None):
         method="POST"
     )
 
+    output_path = os.path.join(OUTPUT_DIR, f"tts_{int(time.time())}.wav")
+    # Stream into a partial file so an interrupted download never leaves a truncated WAV
+    tmp_path = f"{output_path}.part"
+
     try:
         resp = urllib.request.urlopen(req, timeout=120)
-        audio_data = resp.read()
 
-        output_path = os.path.join(OUTPUT_DIR, f"tts_{int(time.time())}.wav")
-        with open(output_path, "wb") as f:
-            f.write(audio_data)
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(resp, f, 1 << 20)
+        os.replace(tmp_path, output_path)
 
         # Print path for Clawdbot to pick up
         print(output_path)
@@ -74,9 +73,16 @@ def generate(text, voice_id=None):
         error_body = e.read().decode("utf-8", errors="ignore")
         print(f"Erreur API: {e.code} - {error_body}", file=sys.stderr)
         sys.exit(1)
+    except urllib.error.URLError:
+        print("Erreur: serveur local non démarré. Lance VoiceCloneMemo ou:", file=sys.stderr)
+        print("  bash ~/.voiceclonememo/start.sh", file=sys.stderr)
+        sys.exit(1)
     except Exception as e:
         print(f"Erreur: {e}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def main():